@@ -6,15 +6,26 @@ python cfet2bfet.py \
     -o /shared/nas/data/m1/yinglin8/projects/fet/data/aida_2020/en/en.bfet.json \
     -m roberta-large \
     -c /shared/nas/data/m1/yinglin8/embedding/bert \
-    -l 128
+    -l 128 \
+    -p 8
 """
-import json
-from typing import List, Tuple
+import os
+import shutil
+import multiprocessing as mp
+from typing import Iterator, List, Tuple
 from argparse import ArgumentParser, Namespace
+
+import orjson
 from transformers import (PreTrainedTokenizerFast,
                           BertTokenizerFast,
                           RobertaTokenizerFast)
 
+# Let the Rust tokenizer encode each batch with multiple threads
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'true')
+
+# Buffer size for reading and writing large JSON-lines files
+BUFFER_SIZE = 1 << 20
+
 
 def create_tokenizer(model_name: str, cache_dir: str) -> PreTrainedTokenizerFast:
     """Creates a tokenizer given a model name.
@@ -32,45 +43,113 @@ def create_tokenizer(model_name: str, cache_dir: str) -> PreTrainedTokenizerFast
         tokenizer = BertTokenizerFast.from_pretrained(
             model_name, cache_dir=cache_dir)
     elif model_name.startswith('roberta'):
+        # Required to tokenize pre-split words
         tokenizer = RobertaTokenizerFast.from_pretrained(
-            model_name, cache_dir=cache_dir)
+            model_name, cache_dir=cache_dir, add_prefix_space=True)
     else:
         raise ValueError('Unknown model name: {}'.format(model_name))
 
     return tokenizer
 
 
-def tokenize(tokens: List[str],
-             tokenizer: PreTrainedTokenizerFast
-            ) -> Tuple[List[str], List[Tuple[int, int]]]:
-    """Converts a token list to a word piece list.
+def get_piece_indices(word_ids: List[int],
+                      token_num: int) -> List[Tuple[int, int]]:
+    """Computes the word piece span of each token from the word ids returned
+    by a fast tokenizer.
 
     Args:
-        tokens (List[str]): a list of tokens.
-        tokenizer (PreTrainedTokenizerFast): a tokenizer that converts tokens
-            to word pieces.
+        word_ids (List[int]): the token index of each word piece. Special
+            tokens (e.g., [CLS] and [SEP]) are mapped to None.
+        token_num (int): number of tokens in the sentence.
 
     Returns:
-        pieces_list_flat (List[str]): a list of word pieces.
-        piece_indices (List[Tuple[int, int]]): a list of index tuples. The 
+        List[Tuple[int, int]]: a list of (start, end) index tuples. The indices
+            are relative to the word piece list without special tokens. Tokens
+            that yield no word pieces are mapped to empty spans.
     """
-    pieces_list = [tokenizer.tokenize(t) for t in tokens]
-    offset = 0
     piece_indices = []
-    pieces_list_flat = []
-    for pieces in pieces_list:
-        end = offset + len(pieces)
-        piece_indices.append((offset, end))
-        offset = end
-        pieces_list_flat.extend(pieces)
-    return pieces_list_flat, piece_indices
+    offset = 0
+    for word_id in word_ids:
+        if word_id is None:
+            continue
+        # Tokens without any word pieces (e.g., control characters)
+        while len(piece_indices) < word_id:
+            piece_indices.append((offset, offset))
+        if len(piece_indices) == word_id:
+            piece_indices.append((offset, offset + 1))
+        else:
+            piece_indices[-1] = (piece_indices[-1][0], offset + 1)
+        offset += 1
+    while len(piece_indices) < token_num:
+        piece_indices.append((offset, offset))
+    return piece_indices
+
+
+def find_shards(input_file: str, shard_num: int) -> List[Tuple[int, int]]:
+    """Splits a file into byte ranges that start and end at line boundaries.
+
+    Args:
+        input_file (str): path to the input file.
+        shard_num (int): number of shards.
+
+    Returns:
+        List[Tuple[int, int]]: a list of (start, end) byte offsets.
+    """
+    file_size = os.path.getsize(input_file)
+    offsets = [0]
+    with open(input_file, 'rb') as r:
+        for shard_idx in range(1, shard_num):
+            r.seek(max(file_size * shard_idx // shard_num, offsets[-1]))
+            # Move to the beginning of the next line
+            r.readline()
+            offsets.append(min(r.tell(), file_size))
+    offsets.append(file_size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:])
+            if start < end]
+
+
+def read_batches(input_file: str,
+                 batch_size: int,
+                 start: int = 0,
+                 end: int = None) -> Iterator[List[dict]]:
+    """Reads instances from a JSON-lines file in batches.
+
+    Args:
+        input_file (str): path to the input file.
+        batch_size (int): max number of instances in each batch.
+        start (int, optional): byte offset to start reading from. It must be
+            the beginning of a line. Defaults to 0.
+        end (int, optional): byte offset to stop reading at. Defaults to None
+            (end of file).
+
+    Yields:
+        List[dict]: a list of instances.
+    """
+    loads = orjson.loads
+    batch = []
+    with open(input_file, 'rb', buffering=BUFFER_SIZE) as r:
+        r.seek(start)
+        offset = start
+        for line in r:
+            if end is not None and offset >= end:
+                break
+            offset += len(line)
+            batch.append(loads(line))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
 
 
 def convert(input_file: str,
             output_file: str,
             bert_model: str = 'bert-large-cased',
             bert_cache_dir: str = None,
-            max_len: int = 128):
+            max_len: int = 128,
+            batch_size: int = 512,
+            start: int = 0,
+            end: int = None) -> int:
     """Converts fine-grained entity typing data from the CFET format to BFET
     format.
 
@@ -81,34 +160,105 @@ def convert(input_file: str,
             'bert-large-cased'.
         bert_cache_dir (str, optional): path to the Bert cache folder. Defaults
             to None.
-        max_len (int, optional): max sentence length. Defaults to 128.
+        max_len (int, optional): max sentence length, including the special
+            tokens. Longer sentences are skipped. Defaults to 128.
+        batch_size (int, optional): number of sentences tokenized at once.
+            Defaults to 512.
+        start (int, optional): byte offset of the first line to convert.
+            Defaults to 0.
+        end (int, optional): byte offset to stop converting at. Defaults to
+            None (end of file).
+
+    Returns:
+        int: number of skipped overlength sentences.
     """
     # Create the tokenizer
     tokenizer = create_tokenizer(bert_model, bert_cache_dir)
-    
-    # [CLS] and [SEP] tokens
-    text_max_len = max_len - 2
-    
+
+    # Bind names used for every instance to locals
+    dumps = orjson.dumps
+    dumps_option = orjson.OPT_APPEND_NEWLINE
+
     overlength_num = 0
-    with open(input_file) as r, open(output_file, 'w') as w:
-        for line in r:
-            inst = json.loads(line)
-            tokens = inst['tokens']
-            pieces, piece_indices = tokenize(tokens)
-            # Skip overlength examples
-            if len(pieces) > text_max_len:
-                overlength_num += 1
-                continue
-            # Convert pieces to piece indices
-            inst['pieces'] = tokenizer.encode(pieces,
-                                              truncation=True,
-                                              max_length=max_len)
-            # Add word piece start/end offsets
-            for annotation in inst['annotations']:
-                annotation['piece_start'] = piece_indices[annotation['start']]
-                annotation['piece_end'] = piece_indices[annotation['end']]
-            
-            w.write(json.dumps(inst) + '\n')
+    with open(output_file, 'wb', buffering=BUFFER_SIZE) as w:
+        for batch in read_batches(input_file, batch_size, start, end):
+            # Tokenize the whole batch in one call. Truncation is disabled so
+            # that overlength examples can be detected from the encoded length.
+            enc = tokenizer([inst['tokens'] for inst in batch],
+                            is_split_into_words=True,
+                            add_special_tokens=True)
+            output = []
+            for inst, encoding in zip(batch, enc.encodings):
+                # Skip overlength examples
+                if len(encoding.ids) > max_len:
+                    overlength_num += 1
+                    continue
+                inst['pieces'] = encoding.ids
+                piece_indices = get_piece_indices(encoding.word_ids,
+                                                  len(inst['tokens']))
+                # Add word piece start/end offsets
+                for annotation in inst['annotations']:
+                    annotation['piece_start'] = piece_indices[
+                        annotation['start']][0]
+                    annotation['piece_end'] = piece_indices[
+                        annotation['end'] - 1][1]
+                output.append(dumps(inst, option=dumps_option))
+            w.write(b''.join(output))
+
+    return overlength_num
+
+
+def _convert_shard(args: tuple) -> int:
+    # Shards are already processed in parallel; avoid oversubscribing the CPUs
+    # with tokenizer threads.
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    return convert(*args)
+
+
+def convert_parallel(input_file: str,
+                     output_file: str,
+                     bert_model: str = 'bert-large-cased',
+                     bert_cache_dir: str = None,
+                     max_len: int = 128,
+                     batch_size: int = 512,
+                     process_num: int = 4) -> int:
+    """Converts the input file with multiple processes. Each process converts
+    a shard of the input file into a temporary file, and these files are
+    concatenated in order afterwards.
+
+    Args:
+        input_file (str): path to the CFET format input file.
+        output_file (str): path to the BFET format output file.
+        bert_model (str, optional): Bert model name. Defaults to
+            'bert-large-cased'.
+        bert_cache_dir (str, optional): path to the Bert cache folder. Defaults
+            to None.
+        max_len (int, optional): max sentence length, including the special
+            tokens. Longer sentences are skipped. Defaults to 128.
+        batch_size (int, optional): number of sentences tokenized at once.
+            Defaults to 512.
+        process_num (int, optional): number of processes. Defaults to 4.
+
+    Returns:
+        int: number of skipped overlength sentences.
+    """
+    shards = find_shards(input_file, process_num)
+    shard_files = ['{}.part{}'.format(output_file, shard_idx)
+                   for shard_idx in range(len(shards))]
+    jobs = [(input_file, shard_file, bert_model, bert_cache_dir, max_len,
+             batch_size, start, end)
+            for shard_file, (start, end) in zip(shard_files, shards)]
+    with mp.Pool(process_num) as pool:
+        overlength_nums = pool.map(_convert_shard, jobs)
+
+    # Merge shard outputs
+    with open(output_file, 'wb') as w:
+        for shard_file in shard_files:
+            with open(shard_file, 'rb') as r:
+                shutil.copyfileobj(r, w, BUFFER_SIZE)
+            os.remove(shard_file)
+
+    return sum(overlength_nums)
 
 
 def parse_arguments() -> Namespace:
@@ -123,6 +273,10 @@ def parse_arguments() -> Namespace:
     parser.add_argument('-m', '--model_name', help='Bert model name')
     parser.add_argument('-c', '--cache_dir', help='Bert cache directory')
     parser.add_argument('-l', '--max_len', type=int, help='Max sentence length')
+    parser.add_argument('-b', '--batch_size', type=int, default=512,
+                        help='Number of sentences tokenized at once')
+    parser.add_argument('-p', '--process_num', type=int, default=1,
+                        help='Number of processes')
     args = parser.parse_args()
     return args
 
@@ -130,11 +284,22 @@ def parse_arguments() -> Namespace:
 def main():
     args = parse_arguments()
 
-    convert(args.input,
-            args.output,
-            args.model_name,
-            args.cache_dir,
-            args.max_len)
+    if args.process_num > 1:
+        overlength_num = convert_parallel(args.input,
+                                          args.output,
+                                          args.model_name,
+                                          args.cache_dir,
+                                          args.max_len,
+                                          args.batch_size,
+                                          args.process_num)
+    else:
+        overlength_num = convert(args.input,
+                                 args.output,
+                                 args.model_name,
+                                 args.cache_dir,
+                                 args.max_len,
+                                 args.batch_size)
+    print('#Overlength: {}'.format(overlength_num))
 
 
 if __name__ == '__main__':
@@ -1,17 +1,31 @@
 import os
-import json
+import sys
 from argparse import ArgumentParser
 from collections import Counter
-import random
+from itertools import chain
+from typing import Iterator, List
+
+import numpy as np
+import orjson
+
+# Buffer size for reading and writing large JSON-lines files
+BUFFER_SIZE = 1 << 20
+
+
+def random_numbers(buffer_size: int = 1 << 16) -> Iterator[float]:
+    """Generates uniform random numbers in [0, 1), drawn in large chunks."""
+    rng = np.random.default_rng()
+    while True:
+        yield from rng.random(buffer_size).tolist()
 
 
 def count_labels(input_file):
     label_count = Counter()
-    with open(input_file) as r:
+    with open(input_file, 'rb', buffering=BUFFER_SIZE) as r:
         for line in r:
-            inst = json.loads(line)
-            for annotation in inst['annotations']:
-                label_count.update(annotation['labels'])
+            inst = orjson.loads(line)
+            label_count.update(chain.from_iterable(
+                annotation['labels'] for annotation in inst['annotations']))
     for label, count in label_count.most_common(len(label_count)):
         print('{}: {}'.format(label, count))
     return label_count
@@ -27,21 +41,23 @@ def downsample(input_file: str,
     label_count = count_labels(input_file)
 
     print('Sampling')
-    with open(input_file) as r, open(output_file, 'w') as w:
+    rand = random_numbers()
+    with open(input_file, 'rb', buffering=BUFFER_SIZE) as r, \
+        open(output_file, 'wb', buffering=BUFFER_SIZE) as w:
         for line in r:
             total_num += 1
-            inst = json.loads(line)
-            inst_label_count = [(label, label_count[label])
-                                for annotation in inst['annotations']
-                                for label in annotation['labels']]
-            inst_label_count.sort(key=lambda x: x[1])
-            min_label_count = inst_label_count[0][1]
-            if min_label_count < threshold:
+            inst = orjson.loads(line)
+            min_label_count = min((label_count[label]
+                                   for annotation in inst['annotations']
+                                   for label in annotation['labels']),
+                                  default=None)
+            # Instances without labels are kept as is
+            if min_label_count is None or min_label_count < threshold:
                 w.write(line)
                 sample_num += 1
             else:
                 ratio = threshold + (min_label_count - threshold) ** .55
-                if random.uniform(0, 1) < ratio / min_label_count:
+                if next(rand) < ratio / min_label_count:
                     w.write(line)
                     sample_num += 1
     print('#Total: {}'.format(total_num))
@@ -55,26 +71,107 @@ def split(input_file: str,
           rate: float = .01):
     label_count = Counter()
     print('Count labels')
-    with open(input_file) as r:
+    with open(input_file, 'rb', buffering=BUFFER_SIZE) as r:
         for line in r:
-            inst = json.loads(line)
-            annotations = inst['annotations']
-            for annotation in annotations:
-                label_count.update(annotation['labels'])
+            inst = orjson.loads(line)
+            label_count.update(chain.from_iterable(
+                annotation['labels'] for annotation in inst['annotations']))
 
     infreq_labels = {label for label, count in label_count.items()
                      if count < threshold}
 
     print('Sampling')
-    with open(input_file, 'r', encoding='utf-8') as r, \
-        open(train_file, 'w', encoding='utf-8') as wt, \
-        open(dev_file, 'w', encoding='utf-8') as wd:
+    rand = random_numbers()
+    with open(input_file, 'rb', buffering=BUFFER_SIZE) as r, \
+        open(train_file, 'wb', buffering=BUFFER_SIZE) as wt, \
+        open(dev_file, 'wb', buffering=BUFFER_SIZE) as wd:
+        for line in r:
+            inst = orjson.loads(line)
+            labels = {label for annotation in inst['annotations']
+                      for label in annotation['labels']}
+            infreq = not labels.isdisjoint(infreq_labels)
+            if infreq or next(rand) > rate:
+                wt.write(line)
+            else:
+                wd.write(line)
+
+
+def process(input_file: str,
+            train_file: str,
+            dev_file: str,
+            ds_threshold: int = 10000,
+            split_threshold: int = 20,
+            split_rate: float = .01,
+            output_file: str = None):
+    """Downsamples the input file and splits the sampled instances into a
+    training set and a development set. This is equivalent to calling
+    downsample() and split() in a row, but reads the input file only twice:
+    the first pass counts labels, and the second pass writes the sampled
+    instances.
+
+    Args:
+        input_file (str): path to the input file.
+        train_file (str): path to the training set file.
+        dev_file (str): path to the development set file.
+        ds_threshold (int, optional): label count threshold for downsampling.
+            Defaults to 10000.
+        split_threshold (int, optional): instances with labels occurring fewer
+            times than this threshold in the sampled data are always put in
+            the training set. Defaults to 20.
+        split_rate (float, optional): ratio of the development set. Defaults
+            to .01.
+        output_file (str, optional): path to the downsampled data file. If
+            None, the downsampled data is not saved. Defaults to None.
+    """
+    print('Counting labels')
+    label_count = Counter()
+    inst_labels: List[tuple] = []
+    with open(input_file, 'rb', buffering=BUFFER_SIZE) as r:
         for line in r:
-            inst = json.loads(line)
-            infreq = any(label in infreq_labels
-                         for annotation in inst['annotations']
-                         for label in annotation['labels'])
-            if infreq or random.uniform(0, 1) > rate:
+            inst = orjson.loads(line)
+            labels = tuple(sys.intern(label)
+                           for annotation in inst['annotations']
+                           for label in annotation['labels'])
+            label_count.update(labels)
+            inst_labels.append(labels)
+    for label, count in label_count.most_common(len(label_count)):
+        print('{}: {}'.format(label, count))
+
+    # Make downsampling decisions using label counts of the input data
+    print('Sampling')
+    rand = random_numbers()
+    sampled = bytearray(len(inst_labels))
+    sample_label_count = Counter()
+    for inst_idx, labels in enumerate(inst_labels):
+        min_label_count = min((label_count[label] for label in labels),
+                              default=None)
+        # Instances without labels are kept as is
+        if min_label_count is None or min_label_count < ds_threshold:
+            sampled[inst_idx] = 1
+        else:
+            ratio = ds_threshold + (min_label_count - ds_threshold) ** .55
+            if next(rand) < ratio / min_label_count:
+                sampled[inst_idx] = 1
+        if sampled[inst_idx]:
+            sample_label_count.update(labels)
+    print('#Total: {}'.format(len(inst_labels)))
+    print('#Sample: {}'.format(sum(sampled)))
+
+    # Split using label counts of the sampled data
+    infreq_labels = {label for label, count in sample_label_count.items()
+                     if count < split_threshold}
+
+    print('Splitting')
+    with open(input_file, 'rb', buffering=BUFFER_SIZE) as r, \
+        open(train_file, 'wb', buffering=BUFFER_SIZE) as wt, \
+        open(dev_file, 'wb', buffering=BUFFER_SIZE) as wd, \
+        open(output_file or os.devnull, 'wb', buffering=BUFFER_SIZE) as w:
+        for line, labels, is_sampled in zip(r, inst_labels, sampled):
+            if not is_sampled:
+                continue
+            w.write(line)
+            infreq = not infreq_labels.isdisjoint(labels)
+            if infreq or next(rand) > split_rate:
                 wt.write(line)
             else:
                 wd.write(line)
@@ -83,9 +180,6 @@ def split(input_file: str,
 if __name__ == '__main__':
     input_file = '/shared/nas/data/m1/yinglin8/projects/fet/data/aida_2020/en/en.aida+kairos.cfet.json'
     output_file = '/shared/nas/data/m1/yinglin8/projects/fet/data/aida_2020/en/en.aida+kairos.cfet.ds3.json'
-    downsample(input_file, output_file, 50000)
-    # count_labels(output_file)
-    
     train_file = '/shared/nas/data/m1/yinglin8/projects/fet/data/aida_2020/en/en.aida+kairos.cfet.ds3.train.json'
     dev_file = '/shared/nas/data/m1/yinglin8/projects/fet/data/aida_2020/en/en.aida+kairos.cfet.ds3.dev.json'
-    split(output_file, train_file, dev_file, 200, 0.005)
+    process(input_file, train_file, dev_file, 50000, 200, 0.005, output_file)
@@ -10,12 +10,17 @@ python wikiann2cfet.py \
     --port 27017
 """
 
-import json
+import sys
 import random
 import logging
 from collections import Counter
+from queue import Queue
+from threading import Thread
+from typing import Iterable, Iterator, List
 from argparse import ArgumentParser, Namespace
 
+import ijson
+import orjson
 from pymongo import MongoClient
 
 
@@ -23,6 +28,86 @@ logging.basicConfig(level=logging.INFO,
                     format='[%(levelname)s] %(asctime)s: %(message)s')
 logger = logging.getLogger(__name__)
 
+# Buffer size for reading and writing large files
+BUFFER_SIZE = 1 << 20
+
+
+def prefetch(iterable: Iterable, maxsize: int = 64) -> Iterator:
+    """Iterates over an iterable in a background thread, so that fetching items
+    (e.g., reading documents from the database) overlaps with processing them.
+
+    Args:
+        iterable (Iterable): the iterable to read from.
+        maxsize (int, optional): max number of prefetched items. Defaults to 64.
+
+    Yields:
+        Items of the iterable in the original order.
+    """
+    queue = Queue(maxsize)
+    end = object()
+    errors = []
+
+    def produce():
+        try:
+            for item in iterable:
+                queue.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            queue.put(end)
+
+    thread = Thread(target=produce, daemon=True)
+    thread.start()
+    while True:
+        item = queue.get()
+        if item is end:
+            break
+        yield item
+    thread.join()
+    # Re-raise errors from the background thread
+    if errors:
+        raise errors[0]
+
+
+def match_tokens(tokens: List[dict],
+                 entities: List[tuple]) -> List[tuple]:
+    """Maps entity character offsets to token indices.
+
+    Entities are sorted by their start offsets, so that all of them are
+    resolved in a single pass over the tokens.
+
+    Args:
+        tokens (List[dict]): a list of tokens with 'start' and 'end' character
+            offsets.
+        entities (List[tuple]): a list of (text, start, end, types) tuples,
+            where start and end are character offsets.
+
+    Returns:
+        List[tuple]: a list of (text, start, end, types) tuples sorted by start
+            offsets, where start and end are token indices (end exclusive).
+            Both indices are None if the entity boundaries do not match token
+            boundaries.
+    """
+    token_num = len(tokens)
+    results = []
+    token_idx = 0
+    for text, start, end, types in sorted(entities, key=lambda x: x[1]):
+        # Move to the first token that does not start before the entity
+        while token_idx < token_num and tokens[token_idx]['start'] < start:
+            token_idx += 1
+        if token_idx == token_num or tokens[token_idx]['start'] != start:
+            results.append((text, None, None, types))
+            continue
+        # Move to the first token that does not end before the entity
+        end_idx = token_idx
+        while end_idx < token_num and tokens[end_idx]['end'] < end:
+            end_idx += 1
+        if end_idx == token_num or tokens[end_idx]['end'] != end:
+            results.append((text, None, None, types))
+            continue
+        results.append((text, token_idx, end_idx + 1, types))
+    return results
+
 
 def extract_data(entity_type_file: str,
                  ontology_file: str,
@@ -87,87 +172,94 @@ def extract_data(entity_type_file: str,
     Round104113641
     ```
     """
-    # Load the mapping table from entity titles to type lists from file
-    logger.info('Loading entity types from {}'.format(entity_type_file))
-    entity_type_map = json.load(open(entity_type_file))
-    logger.info('#Entities: {}'.format(len(entity_type_map)))
-
     # Load target types from the ontology file
     logger.info('Loading target entity types from {}'.format(ontology_file))
-    type_set = set([t.strip() for t in open(ontology_file).read().split('\n')
-                if t.strip()])
+    with open(ontology_file) as r:
+        type_set = frozenset(t.strip() for t in r if t.strip())
     logger.info('#Target Entity Types: {}'.format(len(type_set)))
 
+    # Load the mapping table from entity titles to type lists from file. The
+    # file is parsed incrementally, and only target types and entities with
+    # at least one target type are kept. Types are filtered once here rather
+    # than for every link.
+    logger.info('Loading entity types from {}'.format(entity_type_file))
+    entity_type_map = {}
+    with open(entity_type_file, 'rb') as r:
+        for title, types in ijson.kvitems(r, '', buf_size=BUFFER_SIZE):
+            types = tuple(t for t in types if t in type_set)
+            if types:
+                entity_type_map[sys.intern(title)] = types
+    logger.info('#Entities: {}'.format(len(entity_type_map)))
+
     doc_mention_count = Counter()
     valid_num = entity_num = not_matched_num = title_num = 0
 
-    with open(output_file, 'w', encoding='utf-8') as w:
+    with open(output_file, 'wb', buffering=BUFFER_SIZE) as w:
         with MongoClient(host='127.0.0.1', port=db_port) as client:
             col = client[col_name]['sentences']
 
-            for doc_idx, doc in enumerate(col.find({'len_links': {'$gt': 0}}), 1):
-                doc_id = doc['id']
-                links = doc['links']
-                entities = []
-                for link in links:
-                    if title_field_name not in link:
-                        continue
-                    title = link[title_field_name]
-                    title = title.replace(' ', '_')
-                    if title in entity_type_map:
-                        title_num += 1
-                        # Get types using entity title
-                        types = entity_type_map[title]
-                        # Only keep target types
-                        types = [t for t in types if t in type_set]
-                        # If the entity has at least target types
-                        if types:
-                            entities.append((link['text'],
-                                             link['start'],
-                                             link['end'],
-                                             types))
-
-                # If the sentence contains valid entities
-                if entities:
-                    entity_num += 1
-                    tokens = doc['tokens']
-                    # Map from offsets to indices
-                    token_start_offset_map = {}
-                    token_end_offset_map = {}
-                    for token_idx, token in enumerate(tokens):
-                        token_start_offset_map[token['start']] = token_idx
-                        token_end_offset_map[token['end']] = token_idx + 1
-                    
-                    annotations = []
-                    for idx, (text, start, end, types) in enumerate(entities):
-                        if (start not in token_start_offset_map
-                            or end not in token_end_offset_map):
-                            not_matched_num += 1
+            # Only fetch the fields in use; the cursor may stay open for hours
+            cursor = col.find({'len_links': {'$gt': 0}},
+                              projection={'id': 1,
+                                          'links': 1,
+                                          'tokens': 1,
+                                          '_id': 0},
+                              batch_size=5000,
+                              no_cursor_timeout=True)
+            with cursor:
+                for doc_idx, doc in enumerate(prefetch(cursor), 1):
+                    doc_id = doc['id']
+                    links = doc['links']
+                    entities = []
+                    for link in links:
+                        if title_field_name not in link:
+                            continue
+                        title = link[title_field_name]
+                        # Most titles are already normalized
+                        if ' ' in title:
+                            title = title.replace(' ', '_')
+                        # Get target types using entity title
+                        types = entity_type_map.get(title)
+                        if not types:
                             continue
-                        start = token_start_offset_map[start]
-                        end = token_end_offset_map[end]
-                        annotations.append({
-                            'mention': text,
-                            'mention_id': '{}-{}'.format(
-                                doc_id, doc_mention_count[doc_id]),
-                            'start': start,
-                            'end': end,
-                            'labels': types
-                        })
-                        doc_mention_count[doc_id] += 1
-
-                    # If the sentence has any annotations
-                    if annotations:
-                        valid_num += 1
-                        w.write(json.dumps({
-                            'tokens': [t['text'] for t in tokens],
-                            'annotations': annotations
-                        }) + '\n')
+                        title_num += 1
+                        entities.append((link['text'],
+                                         link['start'],
+                                         link['end'],
+                                         types))
+
+                    # If the sentence contains valid entities
+                    if entities:
+                        entity_num += 1
+                        tokens = doc['tokens']
+                        annotations = []
+                        for text, start, end, types in match_tokens(tokens,
+                                                                    entities):
+                            if start is None:
+                                not_matched_num += 1
+                                continue
+                            annotations.append({
+                                'mention': text,
+                                'mention_id': f'{doc_id}-{doc_mention_count[doc_id]}',
+                                'start': start,
+                                'end': end,
+                                'labels': types
+                            })
+                            doc_mention_count[doc_id] += 1
+
+                        # If the sentence has any annotations
+                        if annotations:
+                            valid_num += 1
+                            w.write(orjson.dumps({
+                                'tokens': [t['text'] for t in tokens],
+                                'annotations': annotations
+                            }, option=orjson.OPT_APPEND_NEWLINE))
                 
-                if doc_idx % 1000 == 0:
-                    print('\r#Processed: {}, #Entities: {}, #Valid: {}, #NotMatched: {}, #Titles: {}'.format(
-                        doc_idx, entity_num, valid_num, not_matched_num, title_num),
-                        end='')
+                    if doc_idx % 10000 == 0:
+                        print(f'\r#Processed: {doc_idx}, #Entities: {entity_num}, '
+                              f'#Valid: {valid_num}, #NotMatched: {not_matched_num}, '
+                              f'#Titles: {title_num}',
+                              end='')
 
 
 def parse_arguments() -> Namespace: